@@ -1,8 +1,13 @@
 import csv
 from datetime import datetime
+import multiprocessing
 import os
 import cPickle as pickle
+import Queue
 import sys
+import threading
+import time
+import traceback
 import urllib2
 
 from pyquery import PyQuery as pq
@@ -11,6 +16,15 @@ from pyquery import PyQuery as pq
 # The maximum number of records to retrieve from Google Code in a single request
 GOOGLE_MAX_RESULTS = 25
 
+# Concurrent downloads of issue pages from Google Code
+FETCH_WORKERS = 4
+# Processes parsing the downloaded pages
+PARSE_WORKERS = multiprocessing.cpu_count()
+# Maximum number of issues waiting between the download, parse and store stages
+PIPELINE_QUEUE_SIZE = 64
+# Seconds to wait for the parse of an issue before giving up
+PARSE_TIMEOUT = 600
+
 EXPORTED_OP_FORMAT_TEMPLATE = u"""
 _From {author} on {date:%B %d, %Y %H:%M:%S}_
 
@@ -29,6 +43,190 @@ GOOGLE_ISSUE_ID_RE = r'http://code.google.com/p/%s/issues/detail\?id=(\d+)'
 issue_separator = u"\n\n?-?-?-?-?-?-?-issue\n"
 field_separator = u"#-#-#-#-#-#-#-field\n"
 
+# format used to render dates in the markdown sent to github
+DATE_FORMAT = "%B %d, %Y %H:%M:%S"
+
+
+# strings repeated across many issues (labels, status, owners) are shared
+_interned_strings = {}
+
+
+def intern_text(text):
+    """returns a canonical instance of text, so equal values share memory"""
+    return _interned_strings.setdefault(text, text)
+
+
+def as_unicode(text):
+    """text as unicode; byte strings, like the fields read from the issues index, are utf-8"""
+    if isinstance(text, str):
+        return text.decode('utf-8')
+    return text
+
+
+class GcodeUser(object):
+    """A googlecode user as seen in the '.userlink' of issues and comments
+
+    Instances are interned: there is only one GcodeUser per (name, href), use
+    gcode_user to obtain them. Unpickling preserves the interning.
+    """
+    __slots__ = ('name', 'href')
+
+    def __init__(self, name, href):
+        self.name = name
+        self.href = href
+
+    def __reduce__(self):
+        return gcode_user, (self.name, self.href)
+
+    def __repr__(self):
+        return 'GcodeUser(%r, %r)' % (self.name, self.href)
+
+    def as_markdown(self):
+        return u'[{0}](https://code.google.com{1})'.format(self.name, self.href)
+
+
+_gcode_users = {}
+
+
+def gcode_user(name, href):
+    """returns the interned GcodeUser for name, href"""
+    key = (name, href)
+    try:
+        return _gcode_users[key]
+    except KeyError:
+        return _gcode_users.setdefault(key, GcodeUser(name, href))
+
+
+def _parse_legacy_author(markdown):
+    """GcodeUser from the '[name](https://code.google.com<href>)' string used by old stores"""
+    name, _, href = markdown[1:-1].partition(u'](https://code.google.com')
+    return gcode_user(name, href)
+
+
+def format_date(date):
+    """ Renders a date stored as seconds since the epoch; text is passed through. """
+    if isinstance(date, basestring):
+        return date
+    return datetime.fromtimestamp(date).strftime(DATE_FORMAT)
+
+
+class Comment(object):
+    """A comment in a googlecode issue
+
+    date: int, seconds since the epoch, or the original text if it could not be parsed
+    author: GcodeUser
+    body: unicode
+    """
+    __slots__ = ('date', 'author', 'body')
+
+    def __init__(self, date, author, body):
+        self.date = date
+        self.author = author
+        self.body = body
+
+    def __getstate__(self):
+        return self.date, self.author, self.body
+
+    def __setstate__(self, state):
+        self.date, self.author, self.body = state
+
+    def as_markdown(self):
+        """the comment as it is sent to github"""
+        return u'_From {0} on {1}_\n\n{2}'.format(self.author.as_markdown(),
+                                                  format_date(self.date),
+                                                  self.body)
+
+    @classmethod
+    def from_dict(cls, d):
+        """converts a comment in the dict format used by old stores"""
+        date = d['date']
+        if isinstance(date, datetime):
+            date = int(time.mktime(date.timetuple()))
+        else:
+            date = parse_gcode_date(date, DATE_FORMAT)
+        return cls(date, _parse_legacy_author(d['author']), d['body'])
+
+
+class Issue(object):
+    """A googlecode issue, as produced by get_gcode_issue
+
+    date: int, seconds since the epoch
+    author: GcodeUser
+    labels: list of unicode
+    comments: list of Comment; comments[0] is the original post
+    content: None until move_comment_0_to_issue_content is applied
+    owner, reporter: names as shown in the issues index, '' if unknown
+    """
+    # new slots go at the end, __setstate__ relies on it to load older stores
+    __slots__ = ('gid', 'title', 'link', 'owner', 'state', 'date', 'status',
+                 'labels', 'author', 'comments', 'content', 'reporter')
+
+    def __init__(self, gid, title, link, owner, state, date, status, labels,
+                 author=None, comments=None, content=None, reporter=''):
+        self.gid = gid
+        self.title = title
+        self.link = link
+        self.owner = intern_text(owner)
+        self.state = intern_text(state)
+        self.date = date
+        self.status = intern_text(status)
+        self.labels = [intern_text(label) for label in labels]
+        self.author = author
+        self.comments = comments if comments is not None else []
+        self.content = content
+        self.reporter = intern_text(reporter)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        self.reporter = ''
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+        self.owner = intern_text(self.owner)
+        self.state = intern_text(self.state)
+        self.status = intern_text(self.status)
+        self.labels = [intern_text(label) for label in self.labels]
+        self.reporter = intern_text(self.reporter)
+
+    def __repr__(self):
+        return '<Issue %d %r>' % (self.gid, self.title)
+
+    @classmethod
+    def from_dict(cls, d):
+        """converts an issue in the dict format used by old stores"""
+        return cls(d['gid'], d['title'], d['link'], d['owner'], d['state'],
+                   int(time.mktime(d['date'].timetuple())), d['status'], d['labels'],
+                   author=_parse_legacy_author(d['author']),
+                   comments=[Comment.from_dict(c) for c in d['comments']],
+                   content=d.get('content'),
+                   reporter=d.get('reporter', ''))
+
+
+def load_issues_pickle(fname):
+    """loads a list of issues pickled by this script, sorted by ID
+
+    The file holds a pickled list of issues, or one pickled issue after
+    another as appended by get_gcode_issues.
+    Stores written by older versions of this script hold plain dicts, they are
+    converted to Issue.
+    """
+    issues = []
+    with open(fname, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            if isinstance(record, list):
+                issues.extend(record)
+            else:
+                issues.append(record)
+    issues = [Issue.from_dict(issue) if isinstance(issue, dict) else issue
+              for issue in issues]
+    issues.sort(key=lambda issue: issue.gid)
+    return issues
+
 
 def gcode_issues_index(google_project_name):
     """
@@ -110,57 +308,68 @@ def get_attachments(link, attachments):
     return body
 
 
-def parse_gcode_date(date_text):
-    """ Transforms a Google Code date into a more human readable string. """
+def parse_gcode_date(date_text, date_format='%a %b %d %H:%M:%S %Y'):
+    """ Transforms a Google Code date into seconds since the epoch.
+
+    If date_text can not be parsed it is returned unchanged.
+    """
 
     try:
-        parsed = datetime.strptime(date_text, '%a %b %d %H:%M:%S %Y')
+        parsed = datetime.strptime(date_text, date_format)
     except ValueError:
         return date_text
 
-    return parsed.strftime("%B %d, %Y %H:%M:%S")
+    return int(time.mktime(parsed.timetuple()))
+
+
+def fetch_gcode_issue_page(link):
+    """ Returns the raw html for the issue details page at link """
+    opener = urllib2.build_opener()
+    return opener.open(link).read()
 
 
 def get_gcode_issue(google_project_name, short_issue):
+    link = GOOGLE_URL.format(google_project_name, short_issue[b'ID'])
+    return parse_gcode_issue(google_project_name, short_issue, fetch_gcode_issue_page(link))
+
+
+def parse_gcode_issue(google_project_name, short_issue, html):
+    """ Builds an Issue from its short form and the html of its details page """
     def get_author(doc):
         userlink = doc('.userlink')
-        return '[{0}](https://code.google.com{1})'.format(userlink.text(), userlink.attr('href'))
+        return gcode_user(userlink.text(), userlink.attr('href'))
 
     # Populate properties available from the summary CSV
-    issue = {
-        'gid': int(short_issue[b'ID']),
-        'title': short_issue['Summary'].replace('%', '&#37;'),
-        'link': GOOGLE_URL.format(google_project_name, short_issue[b'ID']),
-        'owner': short_issue[b'Owner'],
-        'state': 'closed' if short_issue[b'Closed'] else 'open',
-        'date': datetime.fromtimestamp(float(short_issue[b'OpenedTimestamp'])),
-        'status': short_issue[b'Status'].lower(),
-        'labels': short_issue['AllLabels'].decode('utf-8').split(u', ')
-    }
+    issue = Issue(
+        gid=int(short_issue[b'ID']),
+        title=short_issue['Summary'].replace('%', '&#37;'),
+        link=GOOGLE_URL.format(google_project_name, short_issue[b'ID']),
+        owner=short_issue[b'Owner'],
+        reporter=short_issue[b'Reporter'],
+        state='closed' if short_issue[b'Closed'] else 'open',
+        date=int(float(short_issue[b'OpenedTimestamp'])),
+        status=short_issue[b'Status'].lower(),
+        labels=short_issue['AllLabels'].decode('utf-8').split(u', ')
+    )
 
     # Scrape the issue details page for the issue body and comments
-    opener = urllib2.build_opener()
-    doc = pq(opener.open(issue['link']).read())
+    doc = pq(html)
     description = doc('.issuedescription .issuedescription')
-    issue['author'] = get_author(description)
+    issue.author = get_author(description)
 
     comments = []
 
     # comments[0] ~ the Original Post in the issue
-    date = issue['date']
-    author = issue['author']
-    
-    description = doc('.issuedescription .issuedescription')
     OP_text = description('pre').text()
-    footer = GOOGLE_URL.format(google_project_name, issue['gid'])
-    attachments = get_attachments(issue['link'], doc('.issuedescription .issuedescription .attachments'))
+    footer = GOOGLE_URL.format(google_project_name, issue.gid)
+    attachments = get_attachments(issue.link, doc('.issuedescription .issuedescription .attachments'))
     # body was issue['content'] minus the division if too longer
     body = EXPORTED_OP_FORMAT_TEMPLATE.format(content=OP_text,
                                               footer=footer,
                                               attachments=attachments,
-                                              **issue)
-    comment = {'date': date, 'author': author, 'body': body}
-    comments.append(comment)
+                                              author=issue.author.as_markdown(),
+                                              date=datetime.fromtimestamp(issue.date))
+    comments.append(Comment(issue.date, issue.author, body))
 
     # add the comments
     for google_comment in doc('.issuecomment'):
@@ -182,27 +391,152 @@ def get_gcode_issue(google_project_name, short_issue):
         else:
             updates_text = u''
 
-        attachments_text = get_attachments('{0}#{1}'.format(issue['link'], pq_comment.attr('id')), pq_comment('.attachments'))
+        attachments_text = get_attachments('{0}#{1}'.format(issue.link, pq_comment.attr('id')), pq_comment('.attachments'))
 
         body = comment_text + updates_text + attachments_text
 
         # Strip the placeholder text if there's any other updates
         body = body.replace(u'(No comment was entered for this change.)\n\n', u'')
-        comment = {'date': date, 'author': author, 'body': body}
-        comments.append(comment)
+        comments.append(Comment(date, author, body))
 
-    issue['comments'] = comments
+    issue.comments = comments
     return issue
 
 
+def _parse_task(google_project_name, short_issue, html):
+    """ Runs in the parse processes; exceptions are returned as text to be raised in the parent """
+    try:
+        return parse_gcode_issue(google_project_name, short_issue, html), None
+    except Exception:
+        return None, 'Failed parsing issue %s\n%s' % (short_issue[b'ID'], traceback.format_exc())
+
+
+def get_gcode_issues(google_project_name, short_issues, store=None, fetch_workers=FETCH_WORKERS,
+                     parse_workers=PARSE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE):
+    """Returns the full fledged issues for short_issues, sorted by ID
+
+    Work is done in a pipeline:
+        fetch_workers threads download the issue pages
+        a pool of parse_workers processes parse them, so parsing is not limited by the GIL
+        a single writer thread collects the parsed issues and, if store is not None,
+        appends each one to the open file store as soon as it is parsed
+    At most queue_size issues wait between stages, so a slow stage holds back the previous one.
+
+    The first failure aborts the pipeline and is raised; the issues already
+    appended to store are kept, load_issues_pickle can read them.
+    """
+    short_issues = list(short_issues)
+    todo = Queue.Queue()
+    for short_issue in short_issues:
+        todo.put(short_issue)
+    pages = Queue.Queue(queue_size)
+    parsed = Queue.Queue(queue_size)
+    abort = threading.Event()
+    issues = []
+    errors = []
+
+    def fetch():
+        while not abort.is_set():
+            try:
+                short_issue = todo.get_nowait()
+            except Queue.Empty:
+                break
+            link = GOOGLE_URL.format(google_project_name, short_issue[b'ID'])
+            try:
+                page = fetch_gcode_issue_page(link)
+            except Exception as e:
+                page = e
+            pages.put((short_issue, page))
+        pages.put(None)
+
+    def write():
+        storing = store is not None
+        # keeps draining parsed until the end, even after failures, so the
+        # main thread never blocks putting into it
+        while True:
+            item = parsed.get()
+            if item is None:
+                break
+            # even after a failure, the issues already being parsed are stored
+            short_issue, result = item
+            try:
+                try:
+                    issue, error = result.get(PARSE_TIMEOUT)
+                except multiprocessing.TimeoutError:
+                    issue, error = None, 'Timeout parsing issue %s, a parse process may have died' % short_issue[b'ID']
+                except Exception as e:
+                    # by example, the parsed issue could not be sent back from the parse process
+                    issue, error = None, 'Failed parsing issue %s: %r' % (short_issue[b'ID'], e)
+                if error is not None:
+                    errors.append(error)
+                    abort.set()
+                    continue
+                if storing:
+                    try:
+                        pickle.dump(issue, store, pickle.HIGHEST_PROTOCOL)
+                        store.flush()
+                    except Exception:
+                        # by example, disk full; the store may end in a partial record,
+                        # nothing more is written to it
+                        storing = False
+                        raise
+                if len(issues) % 10 == 0:
+                    print '.',
+                issues.append(issue)
+            except Exception as e:
+                errors.append('Failed storing issue %s: %r' % (short_issue[b'ID'], e))
+                abort.set()
+
+    fetchers = [threading.Thread(target=fetch) for _ in xrange(fetch_workers)]
+    writer = threading.Thread(target=write)
+    pool = multiprocessing.Pool(parse_workers)
+    for thread in fetchers + [writer]:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        finished_fetchers = 0
+        while finished_fetchers < fetch_workers:
+            item = pages.get()
+            if item is None:
+                finished_fetchers += 1
+                continue
+            short_issue, page = item
+            if abort.is_set():
+                continue  # only draining the fetchers
+            if isinstance(page, Exception):
+                errors.append('Failed fetching issue %s: %r' % (short_issue[b'ID'], page))
+                abort.set()
+                continue
+            result = pool.apply_async(_parse_task, (google_project_name, short_issue, page))
+            parsed.put((short_issue, result))
+        parsed.put(None)
+        writer.join()
+    except BaseException:
+        # KeyboardInterrupt included
+        abort.set()
+        pool.terminate()
+        raise
+
+    if errors:
+        pool.terminate()
+        raise Exception(errors[0])
+    pool.close()
+    pool.join()
+    if len(issues) != len(short_issues):
+        raise Exception('Only %d of %d issues were parsed' % (len(issues), len(short_issues)))
+    issues.sort(key=lambda issue: issue.gid)
+    return issues
+
+
 # code in this function must be in sync with code in partial_issues_from_editable_text
 def as_editable_text(issues):
     """returns the concatenation of all comments in all issues, with distinct separators"""
     issues_parts = []
     for an_issue in issues:
-        issue_text_parts = [ comment['body'] for comment in an_issue['comments'] ]
+        issue_text_parts = [ comment.body for comment in an_issue.comments ]
         all_comments_text = field_separator.join(issue_text_parts)
-        gid_text = u'%d' % an_issue['gid']
+        gid_text = u'%d' % an_issue.gid
         issue_text = field_separator.join([gid_text, all_comments_text ])
         issues_parts.append(issue_text)
     issues_txt = issue_separator.join(issues_parts)
@@ -218,7 +552,6 @@ def partial_issues_from_editable_text(text):
     issues_parts = text.split(issue_separator)
     for part in issues_parts:
         comments_body = part.split(field_separator)
-        print 'comments_body[0]:', comments_body[0]
         gid = int(comments_body.pop(0))
         partial_issues[gid] = comments_body
     return partial_issues
@@ -232,8 +565,8 @@ def update_issues_comments(issues, partial_issues):
        each one must be in the format returned by partial_issues_from_editable_text
     """
     for an_issue in issues:
-        for comment, new_body in zip(an_issue['comments'], partial_issues[an_issue['gid']]):
-            comment['body'] = new_body
+        for comment, new_body in zip(an_issue.comments, partial_issues[an_issue.gid]):
+            comment.body = new_body
 
 
 def issues_in_gid_range(issues, start=None, end=None):
@@ -241,26 +574,34 @@ def issues_in_gid_range(issues, start=None, end=None):
         start = 1
     if end is None:
         end = len(issues) + 1
-    filtered_issues = [issue for issue in issues if start <= issue['gid'] < end]
+    filtered_issues = [issue for issue in issues if start <= issue.gid < end]
     return filtered_issues
 
 
 def split_long_comments(issue, max_comment_length):
-    """expects issue in the format produced by get_gcode_issue"""
+    """expects issue in the format produced by get_gcode_issue
+
+    Comments with a body longer than max_comment_length are replaced by
+    consecutive comments, sharing date and author, whose bodies are marked
+    with '...' where the text was cut.
+    """
+    mark = u'...'
+    chunk_length = max_comment_length - 2 * len(mark)
     new_comments = []
-    for comment in issue['comments']:
-        if len(comment['body']) > max_comment_length - 3:
-            text = comment['body']
-            comment['body'] = ''
-            while len(text) > len(u'...'):
-                new_comment = comment.copy()
-                new_comment['body'] = text[max_comment_length - 3:] + u'...'
-                new_comments.append(comment)
-                text = u'...' + text[:max_comment_length - 3]
-        else:
+    for comment in issue.comments:
+        text = comment.body
+        if len(text) <= max_comment_length:
             new_comments.append(comment)
+            continue
+        chunks = [text[i:i + chunk_length] for i in xrange(0, len(text), chunk_length)]
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                chunk = mark + chunk
+            if i < len(chunks) - 1:
+                chunk += mark
+            new_comments.append(Comment(comment.date, comment.author, chunk))
 
-    issue['comments'] = new_comments
+    issue.comments = new_comments
 
 
 def load_local_gcode_issues(store_dir, edited=True):
@@ -283,8 +624,7 @@ def load_local_gcode_issues(store_dir, edited=True):
 
      # load full fledged issues from local storage
     fname = os.path.join(store_dir, 'gcode_issues_detailed.pkl')
-    with open(fname, 'rb') as f:
-        gcode_issues = pickle.load(f)
+    gcode_issues = load_issues_pickle(fname)
 
     if edited:
         # load edited text and update the issues with it
@@ -299,10 +639,12 @@ def load_local_gcode_issues(store_dir, edited=True):
     return gcode_issues
 
 
-def main(index_local, issues_local):
+def main(index_local, issues_local, fetch_workers=FETCH_WORKERS, parse_workers=PARSE_WORKERS):
     """
     index_local : True loads the index from local storage, False from googlecode
     issues_local : True loads the full fledged issues from local storage, False from googlecode
+    fetch_workers : number of concurrent downloads from googlecode
+    parse_workers : number of processes parsing the downloaded issues
     """
     if len(sys.argv) < 3 or sys.argv[1] == '-h' or sys.argv[1] == '--help':
         script = os.path.basename(sys.argv[0])
@@ -338,19 +680,25 @@ def main(index_local, issues_local):
     fname = os.path.join(outdir, 'gcode_issues_detailed.pkl')
     if issues_local:
         # load full fledged issues from local storage
-        with open(fname, 'rb') as f:
-            gcode_issues = pickle.load(f)
+        gcode_issues = load_issues_pickle(fname)
         print "*** full fledged issues loaded from local storage"
     else:
-        # build and store locally the detailed issues
-        gcode_issues = []
-        for short_issue in gcode_index:
-            if len(gcode_issues) % 10 == 0:
-                print '.',
-            issue = get_gcode_issue(google_project_name, short_issue)
-            gcode_issues.append(issue)
+        # build and store locally the detailed issues; if a previous run was
+        # interrupted, the issues it already stored are kept
+        stored_issues = []
+        if os.path.exists(fname):
+            stored_issues = load_issues_pickle(fname)
+            print "*** %d issues already stored, resuming" % len(stored_issues)
+        stored_gids = set(issue.gid for issue in stored_issues)
+        pending = [short_issue for short_issue in gcode_index
+                   if int(short_issue[b'ID']) not in stored_gids]
         with open(fname, "wb") as f:
-            pickle.dump(gcode_issues, f)
+            # rewritten, in case the interrupted run left a partial record at the end
+            for issue in stored_issues:
+                pickle.dump(issue, f, pickle.HIGHEST_PROTOCOL)
+            new_issues = get_gcode_issues(google_project_name, pending, f,
+                                          fetch_workers, parse_workers)
+        gcode_issues = sorted(stored_issues + new_issues, key=lambda issue: issue.gid)
         print "\n*** detailed issues  pickled"
 
     # store locally an editable view of issues text
@@ -362,9 +710,18 @@ def main(index_local, issues_local):
     print "*** editable issues text saved in local storage"
 
 if __name__ == "__main__":
+    # Run from the imported module, not from __main__, so the pickled issues
+    # reference gcodeissues.Issue and can be loaded by ghupload.py and others
+    import gcodeissues
+
     # When developing changes you can use the flags to avoid hammering googlecode.
     # Initially both should be False, after a local save is satisfactory the related
     #  flag(s) can be toggled to True
+    # If downloading the detailed issues fails midway, set index_local = True and
+    #  re-run: the issues already stored are kept and only the rest are downloaded
     index_local = False
     issues_local = False
-    main(index_local, issues_local)
+    # Tune to the machine and to how hard googlecode can be hit
+    fetch_workers = gcodeissues.FETCH_WORKERS
+    parse_workers = gcodeissues.PARSE_WORKERS
+    gcodeissues.main(index_local, issues_local, fetch_workers, parse_workers)
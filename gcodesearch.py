@@ -0,0 +1,187 @@
+"""Full text search over the locally stored googlecode issues
+
+Helps to find what to edit in gcode_issues_text.txt before the upload: svn
+revision references, broken markup, sensitive data, ...
+
+The index is a SQLite FTS4 database kept in the same directory as the issues.
+It is updated incrementally: only the issues whose text changed since the
+last update are re-indexed.
+"""
+import hashlib
+import locale
+import os
+import sqlite3
+import sys
+
+import gcodeissues as gco
+
+
+INDEX_FNAME = 'gcode_issues_search.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (gid INTEGER PRIMARY KEY, state TEXT, digest TEXT);
+CREATE TABLE IF NOT EXISTS labels (gid INTEGER, label TEXT);
+CREATE INDEX IF NOT EXISTS labels_label ON labels (label);
+CREATE INDEX IF NOT EXISTS labels_gid ON labels (gid);
+CREATE TABLE IF NOT EXISTS comments (id INTEGER PRIMARY KEY, gid INTEGER, idx INTEGER);
+CREATE INDEX IF NOT EXISTS comments_gid ON comments (gid);
+CREATE VIRTUAL TABLE IF NOT EXISTS comments_text USING fts4 (title, author, labels, body);
+"""
+
+
+def issue_digest(issue):
+    """digest of all the indexed text in an issue, used to detect changes"""
+    h = hashlib.sha1()
+    parts = [issue.title, issue.state] + issue.labels
+    for comment in issue.comments:
+        parts.extend([comment.author.name, comment.body])
+    for part in parts:
+        h.update(part.encode('utf-8') if isinstance(part, unicode) else part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def open_index(store_dir):
+    db = sqlite3.connect(os.path.join(store_dir, INDEX_FNAME))
+    db.executescript(SCHEMA)
+    return db
+
+
+def _remove_issue(db, gid):
+    db.execute('DELETE FROM comments_text WHERE docid IN '
+               '(SELECT id FROM comments WHERE gid = ?)', (gid,))
+    db.execute('DELETE FROM comments WHERE gid = ?', (gid,))
+    db.execute('DELETE FROM labels WHERE gid = ?', (gid,))
+    db.execute('DELETE FROM issues WHERE gid = ?', (gid,))
+
+
+def _add_issue(db, issue, digest):
+    # sqlite3 only accepts unicode for non ascii text, fields from the index are utf-8 bytes
+    title = gco.as_unicode(issue.title)
+    labels = [gco.as_unicode(label) for label in issue.labels]
+    db.execute('INSERT INTO issues (gid, state, digest) VALUES (?, ?, ?)',
+               (issue.gid, gco.as_unicode(issue.state), digest))
+    db.executemany('INSERT INTO labels (gid, label) VALUES (?, ?)',
+                   [(issue.gid, label) for label in labels])
+    for idx, comment in enumerate(issue.comments):
+        cursor = db.execute('INSERT INTO comments (gid, idx) VALUES (?, ?)', (issue.gid, idx))
+        # title and labels belong to the issue, they are indexed only with the original post
+        if idx == 0:
+            issue_title, issue_labels = title, u' '.join(labels)
+        else:
+            issue_title, issue_labels = u'', u''
+        db.execute('INSERT INTO comments_text (docid, title, author, labels, body) '
+                   'VALUES (?, ?, ?, ?, ?)',
+                   (cursor.lastrowid, issue_title, gco.as_unicode(comment.author.name),
+                    issue_labels, gco.as_unicode(comment.body)))
+
+
+def update_index(db, issues):
+    """re-indexes the issues that changed since the last update, returns their number"""
+    indexed = dict(db.execute('SELECT gid, digest FROM issues'))
+    changed = 0
+    with db:
+        for issue in issues:
+            digest = issue_digest(issue)
+            if indexed.pop(issue.gid, None) == digest:
+                continue
+            _remove_issue(db, issue.gid)
+            _add_issue(db, issue, digest)
+            changed += 1
+        # issues no longer in the store
+        for gid in indexed:
+            _remove_issue(db, gid)
+    return changed
+
+
+def index_is_stale(store_dir):
+    """True if the issues were modified after the index was last written"""
+    index_fname = os.path.join(store_dir, INDEX_FNAME)
+    if not os.path.exists(index_fname):
+        return True
+    index_mtime = os.path.getmtime(index_fname)
+    for fname in ('gcode_issues_detailed.pkl', 'gcode_issues_text.txt'):
+        fname = os.path.join(store_dir, fname)
+        if os.path.exists(fname) and os.path.getmtime(fname) > index_mtime:
+            return True
+    return False
+
+
+def update_store_index(store_dir):
+    """updates the index with the issues currently in store_dir, returns the db"""
+    db = open_index(store_dir)
+    edited = os.path.exists(os.path.join(store_dir, 'gcode_issues_text.txt'))
+    issues = gco.load_local_gcode_issues(store_dir, edited=edited)
+    changed = update_index(db, issues)
+    # touch the index even if nothing changed, so it is not seen as stale
+    os.utime(os.path.join(store_dir, INDEX_FNAME), None)
+    # stderr, to keep the output of queries clean
+    print >> sys.stderr, "*** %d issues re-indexed" % changed
+    return db
+
+
+def search(db, query, label=None, state=None, limit=50):
+    """returns a list of (gid, comment index, snippet) for the comments matching query
+
+    query : FTS4 query, like 'r1234' or 'title:crash' or 'author:bob* traceback'
+    label, state : if not None, only issues with that label / state are considered
+    """
+    sql = ("SELECT c.gid, c.idx, snippet(comments_text, '[', ']', '...', -1, 12) "
+           "FROM comments_text JOIN comments c ON c.id = comments_text.docid "
+           "JOIN issues i ON i.gid = c.gid "
+           "WHERE comments_text MATCH ?")
+    params = [query]
+    if state is not None:
+        sql += " AND i.state = ?"
+        params.append(state)
+    if label is not None:
+        sql += " AND c.gid IN (SELECT gid FROM labels WHERE label = ?)"
+        params.append(label)
+    sql += " ORDER BY c.gid, c.idx LIMIT ?"
+    params.append(limit)
+    return db.execute(sql, params).fetchall()
+
+
+def decode_arg(arg):
+    """command line argument as unicode; utf-8, else the encoding of the locale"""
+    try:
+        return arg.decode('utf-8')
+    except UnicodeDecodeError:
+        return arg.decode(locale.getpreferredencoding(), 'replace')
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] in ('-h', '--help') or sys.argv[2] not in ('index', 'query'):
+        script = os.path.basename(sys.argv[0])
+        usage = "Full text search over the googlecode issues stored locally." \
+                "\n\t usage: %s <outdir> index" \
+                "\n\t        %s <outdir> query [--label <label>] [--state open|closed]" \
+                " [--limit <n>] <query>" % (script, script)
+        print usage
+        sys.exit()
+    store_dir = sys.argv[1]
+    if not os.path.isdir(store_dir):
+        print "Error: directory to load googlecode issues does not exists:", store_dir
+        sys.exit(1)
+
+    if sys.argv[2] == 'index' or index_is_stale(store_dir):
+        db = update_store_index(store_dir)
+    else:
+        db = open_index(store_dir)
+    if sys.argv[2] == 'index':
+        return
+
+    options = {'label': None, 'state': None, 'limit': 50}
+    args = [decode_arg(arg) for arg in sys.argv[3:]]
+    while len(args) > 1 and args[0].startswith(u'--') and args[0][2:] in options:
+        name = args.pop(0)[2:]
+        options[name] = args.pop(0)
+    options['limit'] = int(options['limit'])
+    query = u' '.join(args)
+
+    for gid, idx, snippet in search(db, query, **options):
+        print (u'%d\t%d\t%s' % (gid, idx, snippet.replace(u'\n', u' '))).encode('utf-8')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Direct access to the Github API, for what PyGithub does not cover
+
+ConditionalFetcher uses conditional requests to the REST API: each response
+is remembered together with its ETag; asking again for the same url sends
+If-None-Match, and when the resource did not change Github answers
+304 Not Modified, which does not count against the rate limit.
+The remembered responses can be saved to disk so that later runs also benefit.
+
+GraphQLClient sends queries to the GraphQL API, which can fetch in a single
+request what would need many REST requests.
+"""
+import base64
+import cPickle as pickle
+import json
+import os
+import re
+import threading
+import urllib2
+
+
+GITHUB_API_URL = 'https://api.github.com'
+
+# captures the url of the next page from a Link header
+_next_link_re = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+def basic_auth_header(user, password):
+    """ Returns the value for an Authorization header; password can be a token. """
+    return 'Basic ' + base64.b64encode('%s:%s' % (user, password))
+
+
+def token_auth_header(token):
+    """ Returns the value for an Authorization header using an OAuth / personal access token """
+    return 'bearer ' + token
+
+
+def repo_full_name(github_user_name, github_project):
+    """ 'owner/project' for a github_project as configured in ghupload.py """
+    if '/' in github_project:
+        return github_project
+    return '%s/%s' % (github_user_name, github_project)
+
+
+class ConditionalFetcher(object):
+    """ Performs GET requests to the Github API, reusing cached responses when not modified.
+
+    Safe to use from many threads.
+    """
+
+    def __init__(self, user, password, cache_fname=None, api_url=GITHUB_API_URL):
+        """
+        cache_fname : file where the responses are persisted between runs, None to
+           keep them only in memory
+        api_url : root of the API, can point to a local stand-in for tests
+        """
+        self.api_url = api_url
+        self.cache_fname = cache_fname
+        self._authorization = basic_auth_header(user, password)
+        self._lock = threading.Lock()
+        # url -> (etag, data, next_url)
+        self._cache = {}
+        if cache_fname is not None and os.path.exists(cache_fname):
+            with open(cache_fname, 'rb') as f:
+                self._cache = pickle.load(f)
+        self.rate_remaining = None
+        self.requests = 0
+        self.not_modified = 0
+
+    def url(self, path):
+        """ Absolute url for an API path like '/repos/owner/project/issues' """
+        if path.startswith('http'):
+            return path
+        return self.api_url + path
+
+    def get(self, path):
+        """ Returns (data, next_url) for a single page; next_url is None in the last page """
+        url = self.url(path)
+        request = urllib2.Request(url)
+        request.add_header('Authorization', self._authorization)
+        request.add_header('Accept', 'application/vnd.github.v3+json')
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached is not None:
+            request.add_header('If-None-Match', cached[0])
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or cached is None:
+                raise
+            with self._lock:
+                self.requests += 1
+                self.not_modified += 1
+                self._update_rate(e.info())
+            return cached[1], cached[2]
+
+        data = json.loads(response.read().decode('utf-8'))
+        match = _next_link_re.search(response.info().getheader('Link') or '')
+        next_url = match.group(1) if match else None
+        etag = response.info().getheader('ETag')
+        with self._lock:
+            self.requests += 1
+            self._update_rate(response.info())
+            if etag:
+                self._cache[url] = (etag, data, next_url)
+        return data, next_url
+
+    def _update_rate(self, headers):
+        """ Takes the remaining rate limit from the headers of a response; call holding _lock """
+        remaining = headers.getheader('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.rate_remaining = int(remaining)
+
+    def get_all(self, path):
+        """ Returns the concatenation of all pages for a paginated list """
+        items = []
+        url = path
+        while url is not None:
+            data, url = self.get(url)
+            items.extend(data)
+        return items
+
+    def save(self):
+        """ Persists the cached responses, if a cache_fname was given """
+        if self.cache_fname is None:
+            return
+        with self._lock:
+            with open(self.cache_fname, 'wb') as f:
+                pickle.dump(self._cache, f, pickle.HIGHEST_PROTOCOL)
+
+
+class GraphQLError(Exception):
+    pass
+
+
+class GraphQLClient(object):
+    """ Sends queries to the Github GraphQL API """
+
+    def __init__(self, token, api_url=GITHUB_API_URL):
+        """
+        token : OAuth / personal access token; the GraphQL API does not accept passwords
+        api_url : root of the API, can point to a local stand-in for tests
+        """
+        self.url = api_url + '/graphql'
+        self._authorization = token_auth_header(token)
+        self.requests = 0
+
+    def query(self, query, variables=None):
+        """ Returns the 'data' member of the response, raises GraphQLError on errors """
+        payload = json.dumps({'query': query, 'variables': variables or {}})
+        request = urllib2.Request(self.url, payload)
+        request.add_header('Authorization', self._authorization)
+        request.add_header('Content-Type', 'application/json')
+        response = json.loads(urllib2.urlopen(request).read().decode('utf-8'))
+        self.requests += 1
+        if response.get('errors'):
+            raise GraphQLError('; '.join(error.get('message', '?') for error in response['errors']))
+        return response['data']
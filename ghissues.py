@@ -9,6 +9,7 @@ from github import Github
 from github import GithubException, BadCredentialsException
 
 import gcodeissues as gi
+import ghapi
 
 
 # The minimum number of remaining Github rate-limited API requests before we pre-emptively
@@ -19,10 +20,38 @@ GITHUB_SPARE_REQUESTS = 50
 # The maximum characters per comment in Github, a guess because undocumented
 MAX_COMMENT_LENGHT = 7000
 
+# Issues per page when enumerating existing issues with GraphQL; smaller when
+# comment bodies are also retrieved, to keep the responses at a reasonable size
+GRAPHQL_PAGE_SIZE = 100
+GRAPHQL_PAGE_SIZE_WITH_COMMENTS = 25
+
+EXISTING_ISSUES_QUERY = """
+query($owner: String!, $name: String!, $pageSize: Int!, $cursor: String, $withComments: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    issues(first: $pageSize, after: $cursor, orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        body
+        state
+        labels(first: 100) { nodes { name } }
+        commentCount: comments { totalCount }
+        commentBodies: comments(first: 100) @include(if: $withComments) {
+          pageInfo { hasNextPage }
+          nodes { body }
+        }
+      }
+    }
+  }
+}
+"""
+
 
 class GithubMigrationSession(object):
 
     def __init__(self, github_user_name, github_project):
+        self.credentials = None
         self.session = self._get_session(github_user_name)
         self.log_rate_info()
         self.user = self.session.get_user()
@@ -58,6 +87,7 @@ class GithubMigrationSession(object):
                 break
             except BadCredentialsException:
                 print "Bad credentials, try again."
+        self.credentials = (github_user_name, github_password)
         return Github(github_user_name, github_password)
 
     def _get_repo(self, github_project):
@@ -90,8 +120,17 @@ def escape(s):
     return s
 
 
-def add_issue_to_github(gh, issue, assign_owner, dry_run):
-    """ Migrates the given Google Code issue to Github. """
+def github_body(issue):
+    """ The body for the Github copy of issue, in the form process_gcode_issues expects """
+    return issue.content.replace('%', '&#37;')
+
+
+def add_issue_to_github(gh, issue, user_resolver, dry_run):
+    """ Migrates the given Google Code issue to Github.
+
+    user_resolver : ghusers.UserResolver used to assign the issue to its owner,
+       None to leave it unassigned
+    """
 
     # Github rate-limits API requests to 5000 per hour, and if we hit that limit part-way
     # through adding an issue it could end up in an incomplete state.  To avoid this we'll
@@ -100,37 +139,44 @@ def add_issue_to_github(gh, issue, assign_owner, dry_run):
     if gh.session.rate_limiting[0] < GITHUB_SPARE_REQUESTS:
         raise Exception('Aborting to to impending Github API rate-limit cutoff.')
 
-    body = issue['content'].replace('%', '&#37;')
+    body = github_body(issue)
 
-    output('Adding issue %d' % issue['gid'])
+    output('Adding issue %d' % issue.gid)
 
     github_issue = None
 
+    # Assigns issues that originally had an owner to the mapped github user
+    assignee = {}
+    if issue.owner and user_resolver is not None:
+        user = user_resolver.assignee(issue.owner)
+        if user is not None:
+            assignee['assignee'] = user
+
     if not dry_run:
-        github_labels = [gh.label(label) for label in issue['labels']]
-        github_issue = gh.repo.create_issue(issue['title'],
+        github_labels = [gh.label(label) for label in issue.labels]
+        github_issue = gh.repo.create_issue(issue.title,
                                             body = body.encode('utf-8'),
-                                            labels = github_labels)
-
-    # Assigns issues that originally had an owner to the current user
-    if issue['owner'] and assign_owner:
-        assignee = gh.session.get_user(gh.user.login)
-        if not dry_run:
-            github_issue.edit(assignee=assignee)
+                                            labels = github_labels,
+                                            **assignee)
 
     return github_issue
 
 
-def add_comments_to_issue(github_issue, gcode_issue, dry_run):
-    """ Migrates all comments from a Google Code issue to its Github copy. """
+def add_comments_to_issue(github_issue, gcode_issue, dry_run, existing_comments=None):
+    """ Migrates all comments from a Google Code issue to its Github copy.
+
+    existing_comments : bodies of the comments already in github_issue, None to
+       retrieve them from Github
+    """
 
     # Retrieve existing Github comments, to figure out which Google Code comments are new
-    existing_comments = [comment.body for comment in github_issue.get_comments()]
+    if existing_comments is None:
+        existing_comments = [comment.body for comment in github_issue.get_comments()]
 
     # Add any remaining comments to the Github issue
     output(", adding comments")
-    for i, comment in enumerate(gcode_issue['comments']):
-        body = u'_From {author} on {date}_\n\n{body}'.format(**comment)
+    for i, comment in enumerate(gcode_issue.comments):
+        body = comment.as_markdown()
         if body in existing_comments:
             logging.info('Skipping comment %d: already present', i + 1)
         else:
@@ -140,15 +186,39 @@ def add_comments_to_issue(github_issue, gcode_issue, dry_run):
             output('.')
 
 
+def repair_issue(gh, github_issue, issue, dry_run):
+    """ Fixes title, body and labels of an already migrated issue if they differ from issue. """
+    changes = {}
+    title = gi.as_unicode(issue.title)
+    if github_issue.title != title:
+        changes['title'] = title
+    body = github_body(issue)
+    if github_issue.body != body:
+        changes['body'] = body
+    labels = [gi.as_unicode(label) for label in issue.labels]
+    if set(label.name for label in github_issue.labels) != set(labels):
+        changes['labels'] = labels
+
+    if changes:
+        output(', repairing ' + ', '.join(sorted(changes)))
+        if not dry_run:
+            if 'labels' in changes:
+                # create the missing labels
+                changes['labels'] = [gh.label(label).name for label in labels]
+            github_issue.edit(**changes)
+
+
 def process_gcode_issues(gh, google_project_name, existing_issues, gcode_issues,
-                         assign_owner, skip_closed, synchronize_ids, dry_run):
+                         user_resolver, skip_closed, synchronize_ids, dry_run, repair=False):
     """ Migrates all Google Code issues in the given dictionary to Github.
             gcode_issues : list all of gcode issues in the fledged form
+            user_resolver : ghusers.UserResolver to assign owners, None to not assign
+            repair : True also fixes title, body and labels of the issues already in Github
     """
     previous_gid = 1
 
     for issue in gcode_issues:
-        if skip_closed and (issue['state'] == 'closed'):
+        if skip_closed and (issue.state == 'closed'):
             continue
 
         # If we're trying to do a complete migration to a fresh Github project,
@@ -156,7 +226,7 @@ def process_gcode_issues(gh, google_project_name, existing_issues, gcode_issues,
         # need to create dummy closed issues for deleted or missing Google Code
         # issues.
         if synchronize_ids:
-            for gid in xrange(previous_gid + 1, issue['gid']):
+            for gid in xrange(previous_gid + 1, issue.gid):
                 if gid in existing_issues:
                     continue
 
@@ -168,19 +238,31 @@ def process_gcode_issues(gh, google_project_name, existing_issues, gcode_issues,
                 github_issue = gh.repo.create_issue(title, body=body, labels=[gh.label('imported')])
                 github_issue.edit(state='closed')
                 existing_issues[previous_gid] = github_issue
-            previous_gid = issue['gid']
+            previous_gid = issue.gid
 
         # Add the issue and its comments to Github, if we haven't already
-        if issue['gid'] in existing_issues:
-            github_issue = existing_issues[issue['gid']]
-            output('Not adding issue %d (exists)' % issue['gid'])
+        existing_comments = None
+        exists = issue.gid in existing_issues
+        if exists:
+            github_issue = existing_issues[issue.gid]
+            output('Not adding issue %d (exists)' % issue.gid)
+            if isinstance(github_issue, MigratedIssue):
+                # enumerated with GraphQL, only fetch the full issue if there is work to do
+                if not repair and github_issue.is_up_to_date(issue):
+                    github_issue = None
+                    output(', up to date')
+                else:
+                    existing_comments = github_issue.comment_bodies
+                    github_issue = gh.repo.get_issue(github_issue.number)
         else:
-            github_issue = add_issue_to_github(gh, issue, assign_owner, dry_run)
+            github_issue = add_issue_to_github(gh, issue, user_resolver, dry_run)
 
         if github_issue:
-            add_comments_to_issue(github_issue, issue, dry_run)
-            if github_issue.state != issue['state']:
-                github_issue.edit(state=issue['state'])
+            if exists and repair:
+                repair_issue(gh, github_issue, issue, dry_run)
+            add_comments_to_issue(github_issue, issue, dry_run, existing_comments)
+            if github_issue.state != issue.state:
+                github_issue.edit(state=issue.state)
         output('\n')
 
         gh.log_rate_info()
@@ -219,20 +301,116 @@ def get_existing_github_issues(gh, google_project_name):
     return issue_map
 
 
+class MigratedIssue(object):
+    """Summary of a Github issue, as retrieved by get_existing_github_issues_graphql
+
+    state: 'open' or 'closed', like in PyGithub
+    comment_bodies: list of unicode, None when not retrieved
+    """
+    __slots__ = ('number', 'title', 'state', 'labels', 'comment_count', 'comment_bodies')
+
+    def __init__(self, number, title, state, labels, comment_count, comment_bodies=None):
+        self.number = number
+        self.title = title
+        self.state = state
+        self.labels = labels
+        self.comment_count = comment_count
+        self.comment_bodies = comment_bodies
+
+    def __repr__(self):
+        return '<MigratedIssue #%d %r>' % (self.number, self.title)
+
+    @classmethod
+    def from_graphql(cls, node):
+        comment_bodies = None
+        bodies = node.get('commentBodies')
+        if bodies is not None and not bodies['pageInfo']['hasNextPage']:
+            comment_bodies = [comment['body'] for comment in bodies['nodes']]
+        return cls(node['number'], node['title'], node['state'].lower(),
+                   [label['name'] for label in node['labels']['nodes']],
+                   node['commentCount']['totalCount'], comment_bodies)
+
+    def is_up_to_date(self, gcode_issue):
+        """ True if gcode_issue, in the form process_gcode_issues expects, needs no more uploads """
+        if self.state != gcode_issue.state:
+            return False
+        if self.comment_count < len(gcode_issue.comments):
+            # some comments are surely missing, no need to compare the bodies
+            return False
+        if self.comment_bodies is None:
+            # not retrieved, or more than fit in one page: only the comments themselves tell
+            return False
+        existing = set(self.comment_bodies)
+        return all(comment.as_markdown() in existing for comment in gcode_issue.comments)
+
+
+def get_existing_github_issues_graphql(gh, google_project_name, with_comments=True, client=None):
+    """ Returns a dictionary of Github issues previously migrated from Google Code.
+
+    Like get_existing_github_issues, but the result maps Google Code issue numbers
+    to MigratedIssue, all retrieved with a few paginated GraphQL queries.
+
+    with_comments : also retrieve the comment bodies, so process_gcode_issues can
+       skip the issues already complete without more requests
+    client : ghapi.GraphQLClient to use; by default one is built with the session
+       credentials, the password must then be a personal access token
+    """
+
+    output("Retrieving existing Github issues with GraphQL...\n")
+    id_re = re.compile(gi.GOOGLE_ISSUE_ID_RE % google_project_name)
+    if client is None:
+        client = ghapi.GraphQLClient(gh.credentials[1])
+    owner, name = gh.repo.full_name.split('/')
+    variables = {
+        'owner': owner,
+        'name': name,
+        'pageSize': GRAPHQL_PAGE_SIZE_WITH_COMMENTS if with_comments else GRAPHQL_PAGE_SIZE,
+        'cursor': None,
+        'withComments': with_comments,
+    }
+
+    try:
+        existing_count = 0
+        issue_map = {}
+        while True:
+            issues = client.query(EXISTING_ISSUES_QUERY, variables)['repository']['issues']
+            for node in issues['nodes']:
+                existing_count += 1
+                id_match = id_re.search(node['body'] or u'')
+                if not id_match:
+                    continue
+
+                google_id = int(id_match.group(1))
+                issue = MigratedIssue.from_graphql(node)
+                issue_map[google_id] = issue
+                if not u'imported' in issue.labels:
+                    logging.warn('Issue missing imported label %s- %r - %s', google_id, issue.labels, issue.title)
+            if not issues['pageInfo']['hasNextPage']:
+                break
+            variables['cursor'] = issues['pageInfo']['endCursor']
+        imported_count = len(issue_map)
+        logging.info('Found %d Github issues, %d imported, in %d GraphQL requests',
+                     existing_count, imported_count, client.requests)
+    except:
+        logging.error('Failed to enumerate existing issues')
+        raise
+    return issue_map
+
+
 def autoedit_gcode_issue(issue, label_mapping, state_mapping):
     """applies transformations for github migration compatibility / convenience"""
     # apply a custom label mapping
-    labels = [label_mapping[label] for label in issue['labels']
+    labels = [label_mapping[label] for label in issue.labels
                                                    if label in label_mapping]
 
     # add an 'imported' label to help multipass migration / updates
     labels.insert(0, u'imported')
 
     # Add additional labels based on the issue's state
-    if issue['status'] in state_mapping:
-        labels.append(state_mapping[issue['status']])
+    if issue.status in state_mapping:
+        labels.append(state_mapping[issue.status])
 
-    issue['labels'] = labels
+    issue.labels = [gi.intern_text(label) for label in labels]
 
 def move_comment_0_to_issue_content(issue):
-    issue['content'] = issue['comments'].pop(0)['body']
+    issue.content = issue.comments.pop(0).body
@@ -1,9 +1,13 @@
+import getpass
 import logging
 import os
 import sys
 
 import gcodeissues as gco
+import ghapi
 import ghissues as ghi
+import ghusers
+import ghverify
 
 # >>>>>>>>>>>>>>>>>>>>>>> configuration
 
@@ -22,7 +26,8 @@ github_project = 'your project'
 ### for organization projects
 ##github_project = 'organization/project'
 
-# True assigns github_user_name as the issue owner for all issues,
+# True assigns the issues that had an owner in googlecode to the github user
+# given by USER_MAPPING, or to github_user_name if the owner is not mapped;
 # False lets all issues unasigned
 assign_owner = False
 
@@ -32,6 +37,16 @@ synchronize_ids = True
 # Skip all closed bugs
 skip_closed = False
 
+# True enumerates the already migrated issues with a few GraphQL queries instead
+# of many REST requests; needs a personal access token to be entered as password
+use_graphql = False
+
+# With use_graphql, True also retrieves the comments of the migrated issues, so
+# the ones already complete are skipped without more requests. Worth it when
+# re-running over a mostly migrated project; False makes the enumeration lighter
+# when most issues still need uploading
+graphql_with_comments = True
+
 # Range of issues to export, python style: from start up-to but not including
 # end; set end to None to mean 'all issues with ID >= start'
 # ID s are 1-Based 
@@ -53,25 +68,29 @@ STATE_MAPPING = {
     'wontfix': 'wontfix'
 }
 
-# <<<<<<<<<<<<<<<<<<<<<< configuration
+# Mapping from googlecode users to github logins, see ghusers.py
+# Keys can be the names shown in the googlecode issues index (Owner, Reporter)
+# or the user links seen in the issue pages
 
+USER_MAPPING = {
+    # u'facundob...@gmail.com': 'facundob',
+    # u'/u/ccanepa/': 'ccanepa',
+}
 
-def main(dry_run):
-    if not os.path.isdir(gcode_local_dir):
-        print "Error: directory to load googlecode issues does not exists:", gcode_local_dir
-        sys.exit(1)
-
-    logging.basicConfig(level=logging.ERROR)
+# <<<<<<<<<<<<<<<<<<<<<< configuration
 
-    gh = ghi.GithubMigrationSession(github_user_name, github_project)
 
-    existing_issues = ghi.get_existing_github_issues(gh, google_project_name)
-    gh.log_rate_info()
+def prepare_gcode_issues(gids=None):
+    """loads the local issues and transforms them to the form process_gcode_issues expects
 
+    gids : if not None, only the issues with a googlecode ID in gids are kept
+    """
     gcode_issues = gco.load_local_gcode_issues(gcode_local_dir, edited=True)
 
     # filter by ID range
     gcode_issues = gco.issues_in_gid_range(gcode_issues, start, end)
+    if gids is not None:
+        gcode_issues = [issue for issue in gcode_issues if issue.gid in gids]
 
     # apply some convenient automatic transformations
     # map(autoedit_gcode_issue, gcode_issues)
@@ -87,8 +106,64 @@ def main(dry_run):
     for issue in gcode_issues:
         ghi.move_comment_0_to_issue_content(issue)
 
+    return gcode_issues
+
+
+def check_local_dir():
+    if not os.path.isdir(gcode_local_dir):
+        print "Error: directory to load googlecode issues does not exists:", gcode_local_dir
+        sys.exit(1)
+
+
+def main(dry_run, repair_report=None):
+    check_local_dir()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    gh = ghi.GithubMigrationSession(github_user_name, github_project)
+
+    if use_graphql:
+        existing_issues = ghi.get_existing_github_issues_graphql(gh, google_project_name,
+                                                                 graphql_with_comments)
+    else:
+        existing_issues = ghi.get_existing_github_issues(gh, google_project_name)
+    gh.log_rate_info()
+
+    gids = None
+    if repair_report is not None:
+        gids = ghverify.gids_in_report(repair_report)
+    gcode_issues = prepare_gcode_issues(gids)
+
+    user_resolver = None
+    if assign_owner:
+        users_fname = os.path.join(gcode_local_dir, 'github_users.json')
+        user_resolver = ghusers.UserResolver(gh, USER_MAPPING, users_fname,
+                                             default_login=github_user_name,
+                                             dry_run=dry_run)
+        user_resolver.learn_aliases(gcode_issues)
+
     ghi.process_gcode_issues(gh, google_project_name, existing_issues, gcode_issues,
-                             assign_owner, skip_closed, synchronize_ids, dry_run)
+                             user_resolver, skip_closed, synchronize_ids, dry_run,
+                             repair=repair_report is not None)
+
+
+def verify(report_fname):
+    """compares the local issues with the ones in Github, writes a report of discrepancies"""
+    check_local_dir()
+
+    logging.basicConfig(level=logging.INFO)
+
+    github_password = getpass.getpass("Github password: ")
+    etags_fname = os.path.join(gcode_local_dir, 'github_etags.pkl')
+    fetcher = ghapi.ConditionalFetcher(github_user_name, github_password, etags_fname)
+    repo_name = ghapi.repo_full_name(github_user_name, github_project)
+
+    gcode_issues = prepare_gcode_issues()
+    report = ghverify.verify_migration(fetcher, repo_name, google_project_name,
+                                       gcode_issues, skip_closed)
+    ghverify.write_report(report, report_fname)
+    print "%d issues verified, %d with problems; report saved in %s" % (
+        len(gcode_issues), len(report), report_fname)
 
 
 def usage():
@@ -99,11 +174,16 @@ def usage():
     companion utility gcodeissues.py
 
     Usage:
-        %s [--help] [--really]
+        %s [--help] [--really] [--repair <report>] [--verify <report>]
 
     Options:
         --help : displays this message
         --really : really write to Github; dry run if not provided
+        --repair <report> : only upload the issues listed in a report
+            written by --verify, also fixing title, body and labels of the
+            ones already in Github
+        --verify <report> : does not upload; compares the local issues with
+            the ones in Github and writes to <report> the discrepancies found
     """
     print description % os.path.basename(sys.argv[0])
     sys.exit()
@@ -112,13 +192,24 @@ def usage():
 if __name__ == "__main__":
     really = False
     want_help = False
-    if len(sys.argv) > 1:
-        if (sys.argv[1] == '--really'):
+    repair_report = None
+    verify_report = None
+    args = sys.argv[1:]
+    while args and not want_help:
+        arg = args.pop(0)
+        if arg == '--really':
             really = True
+        elif arg == '--repair' and args:
+            repair_report = args.pop(0)
+        elif arg == '--verify' and args:
+            verify_report = args.pop(0)
         else:
             want_help = True
     if want_help:
         usage()
-    dry_run = not really
-    main(dry_run)
+    if verify_report is not None:
+        verify(verify_report)
+    else:
+        dry_run = not really
+        main(dry_run, repair_report)
 
@@ -0,0 +1,127 @@
+"""Maps googlecode users to github logins
+
+The mapping table (USER_MAPPING in ghupload.py) maps googlecode users to github
+logins. A googlecode user can be identified by any of the forms seen in the
+stored issues:
+    the name shown in the Owner / Reporter columns of the issues index,
+        like 'facundob...@gmail.com'
+    the text of a '.userlink' in the issue pages, usually the same name or
+        a googlecode username
+    the href of a '.userlink', like '/u/ccanepa/'
+The Reporter of an issue is the author of its original post, so an entry
+given for the userlink of a user also applies to its name in the index.
+
+Each distinct github login is validated once, by checking that it exists and
+can be assigned issues in the repo; the results are cached on disk, per repo,
+so a trial migration to a test repo does not affect the real one. Errors
+like rate limits or outages are raised, not cached as an invalid login.
+"""
+import json
+import logging
+import os
+
+from github import GithubException
+
+import gcodeissues as gi
+
+
+class UserResolver(object):
+
+    def __init__(self, gh, mapping, cache_fname=None, default_login=None, dry_run=False):
+        """
+        gh : GithubMigrationSession
+        mapping : dict googlecode user -> github login
+        cache_fname : json file where the validation results are kept between runs,
+           for each target repo
+        default_login : login used for users not in mapping; None leaves them unresolved
+        dry_run : True reads cache_fname but does not write it
+        """
+        self.gh = gh
+        self.mapping = mapping
+        self.cache_fname = cache_fname
+        self.default_login = default_login
+        self.dry_run = dry_run
+        # index name -> GcodeUser
+        self._aliases = {}
+        # repo full name -> {github login -> True if it can be assigned issues in the repo}
+        self._cache = {}
+        if cache_fname is not None and os.path.exists(cache_fname):
+            with open(cache_fname, 'rb') as f:
+                cache = json.load(f)
+            # entries not keyed by repo, from older versions, are discarded
+            self._cache = dict((repo, valid) for repo, valid in cache.items()
+                               if isinstance(valid, dict))
+        self._valid = self._cache.setdefault(gh.repo.full_name, {})
+        # github login -> NamedUser, for the valid logins used in this run
+        self._users = {}
+
+    def learn_aliases(self, issues):
+        """ Learns from the issues which userlink corresponds to each name in the index """
+        for issue in issues:
+            if issue.reporter and issue.author is not None:
+                self._aliases.setdefault(gi.as_unicode(issue.reporter), issue.author)
+
+    def login(self, gcode_name):
+        """ Returns the github login for a googlecode user, None if it can not be resolved
+
+        gcode_name : name as shown in the issues index Owner / Reporter columns
+        """
+        gcode_name = gi.as_unicode(gcode_name)
+        keys = [gcode_name]
+        user = self._aliases.get(gcode_name)
+        if user is not None:
+            keys.extend([user.href, user.name])
+        for key in keys:
+            login = self.mapping.get(key)
+            if login is not None:
+                break
+        else:
+            login = self.default_login
+
+        if login is None or not self.is_valid(login):
+            return None
+        return login
+
+    def assignee(self, gcode_name):
+        """ Returns the github NamedUser for a googlecode user, None if it can not be resolved
+
+        gcode_name : name as shown in the issues index Owner / Reporter columns
+        """
+        login = self.login(gcode_name)
+        if login is None:
+            return None
+        try:
+            return self._users[login]
+        except KeyError:
+            # valid from the cache of a previous run
+            return self._users.setdefault(login, self.gh.session.get_user(login))
+
+    def is_valid(self, login):
+        try:
+            return self._valid[login]
+        except KeyError:
+            valid = self._validate(login)
+            if not valid:
+                logging.warn('Github user %s can not be assigned issues in %s', login, self.gh.repo.full_name)
+            self._valid[login] = valid
+            self.save()
+            return valid
+
+    def _validate(self, login):
+        """ True if login can be assigned issues; errors other than an unknown user are raised """
+        try:
+            user = self.gh.session.get_user(login)
+        except GithubException as e:
+            if e.status == 404:
+                return False
+            raise
+        if not self.gh.repo.has_in_assignees(user):
+            return False
+        self._users[login] = user
+        return True
+
+    def save(self):
+        if self.cache_fname is None or self.dry_run:
+            return
+        with open(self.cache_fname, 'wb') as f:
+            json.dump(self._cache, f, indent=1, sort_keys=True)
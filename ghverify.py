@@ -0,0 +1,153 @@
+"""Verifies that the issues in the local store were correctly migrated to Github
+
+For each googlecode issue checks that a github issue exists with the right
+title, state, labels, body and comments. Comments are compared by count and
+by digest.
+
+All requests are conditional (see ghapi.py), so re-verifying after each
+migration pass costs almost nothing from the Github rate limit.
+
+The result is a list of discrepancies which can be saved as a report; the
+report can be given to ghupload.py --repair to re-run the migration only over
+the issues with problems. That run adds missing issues and comments, and fixes
+state, title, body and labels.
+Github issues duplicating another migrated issue are reported but not repaired,
+they must be closed or deleted by hand.
+"""
+import hashlib
+import json
+import logging
+import re
+from multiprocessing.pool import ThreadPool
+
+import gcodeissues as gi
+import ghissues as ghi
+
+
+# Number of concurrent requests to Github while verifying
+VERIFY_WORKERS = 8
+
+
+def digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_migrated_github_issues(fetcher, repo_name, google_project_name):
+    """ Returns (issue_map, duplicates)
+
+    issue_map maps googlecode ids to github issues, as dicts from the API
+    duplicates is a list of github issues whose googlecode id was already
+    seen in another github issue
+    """
+    id_re = re.compile(gi.GOOGLE_ISSUE_ID_RE % google_project_name)
+    all_issues = fetcher.get_all('/repos/%s/issues?state=all&per_page=100' % repo_name)
+    issue_map = {}
+    duplicates = []
+    for github_issue in all_issues:
+        if 'pull_request' in github_issue:
+            continue
+        id_match = id_re.search(github_issue['body'] or u'')
+        if not id_match:
+            continue
+        gid = int(id_match.group(1))
+        if gid in issue_map:
+            duplicates.append(github_issue)
+        else:
+            issue_map[gid] = github_issue
+    return issue_map, duplicates
+
+
+def verify_issue(fetcher, issue, github_issue):
+    """ Returns a list of problems found, empty if github_issue matches issue
+
+    issue : in the form process_gcode_issues expects
+    github_issue : dict from the API, or None if not migrated
+    """
+    if github_issue is None:
+        return ['missing']
+
+    problems = []
+    if github_issue['title'] != gi.as_unicode(issue.title):
+        problems.append('title differs')
+    if github_issue['state'] != issue.state:
+        problems.append('state is %s' % github_issue['state'])
+    labels = set(label['name'] for label in github_issue['labels'])
+    expected_labels = set(gi.as_unicode(label) for label in issue.labels)
+    if labels != expected_labels:
+        problems.append('labels differ: %s' % ', '.join(sorted(labels ^ expected_labels)))
+    if digest(github_issue['body'] or u'') != digest(ghi.github_body(issue)):
+        problems.append('body differs')
+
+    expected = [digest(comment.as_markdown()) for comment in issue.comments]
+    if github_issue['comments'] != len(expected):
+        problems.append('has %d comments, expected %d' % (github_issue['comments'], len(expected)))
+    if github_issue['comments'] == 0 and not expected:
+        return problems
+    comments = fetcher.get_all(github_issue['comments_url'] + '?per_page=100')
+    actual = [digest(comment['body']) for comment in comments]
+    for i, expected_digest in enumerate(expected):
+        if expected_digest not in actual:
+            problems.append('comment %d missing or different' % (i + 1))
+    if [d for d in actual if d in expected] != [d for d in expected if d in actual]:
+        problems.append('comments out of order')
+    return problems
+
+
+def verify_migration(fetcher, repo_name, google_project_name, gcode_issues,
+                     skip_closed=False, workers=VERIFY_WORKERS):
+    """ Returns a list of discrepancies between gcode_issues and the Github repo
+
+    gcode_issues : in the form process_gcode_issues expects
+    Each discrepancy is a dict with keys 'gid', 'number' (None if not in github)
+    and 'problems', a list of strings; github issues duplicating another one
+    also have the key 'duplicate' set to True.
+    The responses collected are saved even if the verification fails midway.
+    """
+    pool = ThreadPool(workers)
+    report = []
+    try:
+        existing = pool.apply_async(get_migrated_github_issues,
+                                    (fetcher, repo_name, google_project_name))
+        if skip_closed:
+            gcode_issues = [issue for issue in gcode_issues if issue.state != 'closed']
+        issue_map, duplicates = existing.get()
+
+        def verify(issue):
+            github_issue = issue_map.get(issue.gid)
+            return issue, github_issue, verify_issue(fetcher, issue, github_issue)
+
+        for issue, github_issue, problems in pool.imap(verify, gcode_issues):
+            if problems:
+                number = github_issue['number'] if github_issue else None
+                report.append({'gid': issue.gid, 'number': number, 'problems': problems})
+    finally:
+        pool.close()
+        pool.join()
+        fetcher.save()
+
+    for github_issue in duplicates:
+        gid = int(re.search(gi.GOOGLE_ISSUE_ID_RE % google_project_name,
+                            github_issue['body']).group(1))
+        report.append({'gid': gid, 'number': github_issue['number'],
+                       'problems': ['duplicated, first copy is #%d' % issue_map[gid]['number']],
+                       'duplicate': True})
+
+    logging.info('Verify: %d requests, %d not modified, rate limit remaining %s',
+                 fetcher.requests, fetcher.not_modified, fetcher.rate_remaining)
+    return report
+
+
+def write_report(report, fname):
+    with open(fname, 'wb') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+
+def gids_in_report(fname):
+    """ Returns the set of googlecode ids with problems in a report written by write_report
+
+    Duplicates are left out, a repair run can not fix them.
+    """
+    with open(fname, 'rb') as f:
+        report = json.load(f)
+    return set(discrepancy['gid'] for discrepancy in report
+               if not discrepancy.get('duplicate'))